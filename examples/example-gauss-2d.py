@@ -23,10 +23,11 @@ def tinker_ppv(arr):
     rel_shift = 30
     rel_str = 5
     shifted_component = np.roll(arr, rel_shift) / rel_str
-    for y, x in np.ndindex(arr.shape[1:]):
-        roll = np.sqrt((x - 5)**2 + (y - 5)**2) * scale_roll
-        arr[:, y, x] = np.roll(arr[:, y, x], int(roll))
-    return arr + shifted_component
+    # rolling every spectrum by its own shift in one go
+    yy, xx = np.indices(arr.shape[1:])
+    roll = (np.sqrt((xx - 5)**2 + (yy - 5)**2) * scale_roll).astype(int)
+    idx = (np.arange(arr.shape[0])[:, None, None] - roll) % arr.shape[0]
+    return np.take_along_axis(arr, idx, axis=0) + shifted_component
 sc.cube = tinker_ppv(sc.cube)
 
 sc.update_model('gaussian')
@@ -0,0 +1,105 @@
+"""
+Compiled kernels for the number-crunching bits of SubCube.
+
+Numba is an optional dependency here: if it can't be imported, HAS_NUMBA
+is set to False and the callers are expected to use their numpy versions.
+"""
+from __future__ import division
+import math
+import numpy as np
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def accepts(*arrays):
+    """
+    Checks if the kernels can be used on the given arrays: numba has to
+    be installed, and it only takes plain arrays in native byte order
+    (unlike, e.g., masked arrays or big-endian data read from FITS files).
+    """
+    return HAS_NUMBA and all(not np.ma.isMaskedArray(a) and
+                             np.asarray(a).dtype.isnative for a in arrays)
+
+if HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def gauss_grid(xarr, amp, cen, wid, out):
+        """
+        Sums the gaussian components for every guess of the grid,
+        writing the (N, L)-shaped result into a preallocated `out`.
+
+        Parameters
+        ----------
+        xarr : (L,)-shaped spectral axis values
+
+        amp, cen, wid : (N, ncomp)-shaped arrays of the gaussian
+                        amplitudes, centers, and widths
+        """
+        nguesses, ncomp = amp.shape
+        for i in prange(nguesses):
+            for k in range(xarr.size):
+                s = 0.
+                for c in range(ncomp):
+                    d = (xarr[k] - cen[i, c]) / wid[i, c]
+                    s += amp[i, c] * math.exp(-0.5 * d * d)
+                out[i, k] = s
+
+    @njit(parallel=True, cache=True)
+    def snr_maps(cube, signal_idx, noise_idx, signal_map, rms_map):
+        """
+        Fills in the peak signal and the MAD-based rms maps in a single
+        sweep through the cube: every spectrum is read once, and its noise
+        channels are copied into a small buffer for the median estimates.
+        As with their numpy counterparts, any NaN value among the
+        signal (noise) channels makes the signal (rms) of that pixel NaN.
+
+        Parameters
+        ----------
+        cube : (L, Y, X)-shaped data cube
+
+        signal_idx, noise_idx : 1d integer arrays of the channel indices
+                                to look for the signal and noise in
+        """
+        ny, nx = signal_map.shape
+        for y in prange(ny):
+            sbuf = np.empty(signal_idx.size, dtype=cube.dtype)
+            nbuf = np.empty(noise_idx.size, dtype=cube.dtype)
+            for x in range(nx):
+                signal_ok, noise_ok = True, True
+                for i in range(signal_idx.size):
+                    sbuf[i] = cube[signal_idx[i], y, x]
+                    if np.isnan(sbuf[i]):
+                        signal_ok = False
+                for i in range(noise_idx.size):
+                    nbuf[i] = cube[noise_idx[i], y, x]
+                    if np.isnan(nbuf[i]):
+                        noise_ok = False
+                signal_map[y, x] = np.max(sbuf) if signal_ok else np.nan
+                if not noise_ok:
+                    rms_map[y, x] = np.nan
+                    continue
+                med = np.median(nbuf)
+                for i in range(noise_idx.size):
+                    nbuf[i] = abs(nbuf[i] - med)
+                # same normalization as in astropy.stats.mad_std
+                rms_map[y, x] = 1.482602218505602 * np.median(nbuf)
+
+    @njit(parallel=True, cache=True)
+    def residual_ssr(cube, modelcube, out):
+        """
+        Sums the squared residuals between two (L, Y, X)-shaped cubes
+        along the spectral axis into a (Y, X)-shaped `out` map, without
+        making any cube-sized temporary arrays.
+        """
+        nchan, ny, nx = cube.shape
+        for y in prange(ny):
+            acc = np.zeros(nx)
+            for k in range(nchan):
+                for x in range(nx):
+                    d = cube[k, y, x] - modelcube[k, y, x]
+                    acc[x] += d * d
+            for x in range(nx):
+                out[y, x] = acc[x]
@@ -6,31 +6,37 @@ import os
 #       Having a bundle of test filaments would be very nice.
 
 def make_test_cube(shape=(30,9,9), outfile='test.fits',
-                   sigma=None, seed=0, writeSN=False   ):
+                   sigma=None, seed=0, writeSN=False, checksum=False):
     """
     Generates a simple gaussian cube with noise of
     given shape and writes it as a fits file.
+
+    Set `checksum` to True to add the CHECKSUM and
+    DATASUM cards to the written fits files.
     """
-    from astropy.convolution import Gaussian1DKernel, Gaussian2DKernel
     if sigma is None:
         sigma1d, sigma2d = shape[0]/10., np.mean(shape[1:])/5.
     else:
         sigma1d, sigma2d = sigma
 
-    gauss1d = Gaussian1DKernel(stddev=sigma1d, x_size=shape[0])
-    gauss2d = Gaussian2DKernel(stddev=sigma2d, x_size=shape[1],
-                                               y_size=shape[2])
-    signal_cube = gauss1d.array[:,None,None] * gauss2d.array
+    # a separable gaussian, peaking in the middle of the cube (between
+    # the two central pixels for even sizes, as astropy's kernels do)
+    z = np.arange(shape[0]) - (shape[0]-1)/2.
+    yy, xx = (np.indices(shape[1:])
+              - ((np.array(shape[1:])-1)/2.)[:,None,None])
+    gauss1d = np.exp(-0.5*(z/sigma1d)**2)
+    gauss2d = np.exp(-0.5*(yy**2+xx**2)/sigma2d**2)
+    signal_cube = gauss1d[:,None,None] * gauss2d
     signal_cube=signal_cube/signal_cube.max()
-    # adding noise:
-    np.random.seed(seed)
-    noise_cube = (np.random.random(signal_cube.shape)-.5)* \
-                        np.median(signal_cube.std(axis=0))
+    # adding gaussian noise, at the same rms level as the
+    # uniformly distributed noise that was used before
+    sigma_n = np.median(signal_cube.std(axis=0)) / np.sqrt(12)
+    rng = np.random.default_rng(seed)
+    noise_cube = rng.standard_normal(signal_cube.shape) * sigma_n
     test_cube = signal_cube+noise_cube
     true_rms = noise_cube.std()
 
     # making a simple header for the test cube:
-    test_hdu = fits.PrimaryHDU(test_cube)
     # the strange cdelt values are a workaround
     # for what seems to be a bug in wcslib:
     # https://github.com/astropy/astropy/issues/4555
@@ -49,15 +55,15 @@ def make_test_cube(shape=(30,9,9), outfile='test.fits',
     test_header = fits.Header()
     test_header.update(keylist)
     test_hdu = fits.PrimaryHDU(data=test_cube, header=test_header)
-    test_hdu.writeto(outfile, clobber=True, checksum=True)
+    test_hdu.writeto(outfile, overwrite=True, checksum=checksum)
 
     if writeSN:
         signal_hdu = fits.PrimaryHDU(data=signal_cube, header=test_header)
         noise_hdu  = fits.PrimaryHDU(data=noise_cube , header=test_header)
         signame, noiname = [outfile.split('.fits')[0]+'-'+i+'.fits'
                                             for i in ['signal','noise']]
-        signal_hdu.writeto(signame, clobber=True, checksum=True)
-        noise_hdu.writeto( noiname, clobber=True, checksum=True)
+        signal_hdu.writeto(signame, overwrite=True, checksum=checksum)
+        noise_hdu.writeto( noiname, overwrite=True, checksum=checksum)
 
 def download_test_cube(outfile='test.fits'):
     """
@@ -73,17 +79,74 @@ def download_test_cube(outfile='test.fits'):
         import shutil
         shutil.move(tmp_path, outfile)
 
+_ncores = None
+
 def get_ncores():
     """
-    Try to get the number of cpu cores
+    Get the number of cpu cores available to the current process,
+    as limited by its cpu affinity (e.g., inside containers or on
+    a cluster node slice) rather than the total cpu count.
+    """
+    global _ncores
+    if _ncores is None:
+        try:
+            _ncores = len(os.sched_getaffinity(0))
+        except AttributeError: # would happen on Macs/Windows
+            _ncores = os.cpu_count() or 1
+
+    return _ncores
+
+def get_available_memory():
+    """
+    Get the amount of RAM available for new allocations, in bytes.
+
+    Tries psutil first, then MemAvailable from /proc/meminfo, then the
+    POSIX sysconf values, and then the Windows GlobalMemoryStatusEx call.
+    Returns None if none of those work.
     """
     try:
-        import multiprocessing
-        ncores = multiprocessing.cpu_count()
+        import psutil
+        return psutil.virtual_memory().available
     except ImportError:
-        ncores = 1
+        pass
+
+    # unlike the free pages from sysconf, this counts in
+    # the page cache that the kernel can reclaim on demand
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError): # not on Linux
+        pass
 
-    return ncores
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError): # Macs/Windows
+        pass
+
+    try:
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+    except (ImportError, AttributeError, OSError):
+        pass
+
+    return None
 
 def in_ipynb():
     """
@@ -3,15 +3,22 @@ import numpy as np
 import matplotlib.pylab as plt
 import astropy.units as u
 from astropy import log
+from astropy.stats import mad_std
+from scipy.linalg.blas import get_blas_funcs
 from astropy.utils.console import ProgressBar
 import pyspeckit
 import os
+import logging
+import tempfile
 
 # imports for the test fiteach redefinition
 import time
 import itertools
 from six import string_types
 
+from . import _kernels
+from .astro_toolbox import get_available_memory
+
 
 # gotta catch 'em all!
 class AllFixedException(Exception):
@@ -37,8 +44,13 @@ class SubCube(pyspeckit.Cube):
     on a spectral model chosen (so that parent MultiCube doesn't weigh so much)
 
     Is designed to have methods that operate within a single spectral model.
+
+    Apart from the pyspeckit.Cube arguments, accepts a `precision` keyword,
+    'float32' (default) or 'float64', for the data type of the model grid
+    and of the residuals computed for choosing the best guesses.
     """
     def __init__(self, *args, **kwargs):
+        precision = kwargs.pop('precision', 'float32')
         super(SubCube, self).__init__(*args, **kwargs)
 
         # because that UnitConversionError pops up way too often
@@ -55,6 +67,43 @@ class SubCube(pyspeckit.Cube):
         self.guess_grid = None
         self.model_grid = None
 
+        # single precision is plenty for picking the initial guesses,
+        # and halves the memory traffic of the model grid comparisons
+        if np.dtype(precision) not in (np.float32, np.float64):
+            raise ValueError("precision should be either "
+                             "'float32' or 'float64'.")
+        self.precision = np.dtype(precision).type
+
+    @property
+    def cube(self):
+        """ The (L, Y, X)-shaped data cube. """
+        return self._cube
+
+    @cube.setter
+    def cube(self, value):
+        self._cube = value
+        # anything derived from the old cube is no longer valid
+        self._cube_flat_T = {}
+
+    def _get_cube_flat_T(self, dtype):
+        """
+        A (Y*X, L)-shaped, C-contiguous copy of the cube holding one
+        spectrum per row, cached for every data type requested. Masked
+        values of a masked cube are set to NaN in the copy.
+
+        The cache is reset whenever a new cube is assigned to SubCube.cube,
+        but in-place modifications of the cube will go unnoticed.
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in self._cube_flat_T:
+            # masked values are turned into NaNs, so that the spectra
+            # with them are left out just as the non-finite ones are
+            cube = np.ma.filled(self.cube, np.nan)
+            flat_cube = cube.reshape(cube.shape[0], -1).T
+            self._cube_flat_T[dtype] = np.ascontiguousarray(flat_cube,
+                                                            dtype=dtype)
+        return self._cube_flat_T[dtype]
+
     # TODO: investigate whether pyspeckit's #179 needs to be hacked
     #       around inside either update_model or make_guess_grid methods
     def update_model(self, fit_type='gaussian'):
@@ -73,6 +122,13 @@ class SubCube(pyspeckit.Cube):
         self.specfit.fittype = fit_type
         self.fittype = fit_type
 
+        # a plain array copy of the spectral axis for the model grid
+        # kernels: unlike the xarr quantity, it doesn't need to go
+        # through unit checks on every access
+        # NOTE: call update_model again if the xarr units are changed!
+        self._xarr_np = np.ascontiguousarray(self.xarr.value,
+                                             dtype=np.float64)
+
     def make_guess_grid(self, minpars, maxpars, finesse, fixed=None,
                         limitedmin=None, limitedmax=None, **kwargs):
         """
@@ -100,6 +156,10 @@ class SubCube(pyspeckit.Cube):
         limitedmax : an iterable of booleans controlling if the fit fixed
                      the maximal boundary of from maxpars.
 
+        Additional keyword arguments, like clip_edges and scale, are passed
+        to SubCube._par_space, and spacing, which, and npeaks are passed to
+        SubCube._remove_close_peaks.
+
         Returns
         -------
         guess_grid : a grid of guesses to use for SubCube.generate_model
@@ -109,21 +169,12 @@ class SubCube(pyspeckit.Cube):
         ['fixed', 'limitedmin', 'limitedmax', 'minpars', 'maxpars']
         """
         minpars, maxpars = np.asarray([minpars, maxpars])
-        truths, falses = (np.ones(minpars.shape, dtype=bool),
-                          np.zeros(minpars.shape, dtype=bool))
-
-        fixed = falses if fixed is None else fixed
-        limitedmin = truths if limitedmin is None else limitedmin
-        limitedmax = truths if limitedmax is None else limitedmax
-        self.fiteach_args = {'fixed'     : fixed,
-                             'limitedmin': limitedmin,
-                             'limitedmax': limitedmax,
-                             'minpars'   : minpars,
-                             'maxpars'   : maxpars    }
+        self.fiteach_args = self._make_fiteach_args(minpars, maxpars, fixed,
+                                                    limitedmin, limitedmax)
 
         # TODO: why does 'fixed' break the gaussian fitter?
         #       update as of 1.08.2016: this doesn't happen anymore
-        #if self.fittype is 'gaussian':
+        #if self.fittype == 'gaussian':
         #    self.fiteach_args.pop('fixed')
 
         guess_grid = self._grid_parspace(minpars, maxpars, finesse, **kwargs)
@@ -163,17 +214,8 @@ class SubCube(pyspeckit.Cube):
         self.fiteach_args['maxpars'] = maxpars
 
         # updating the fiteach_arg grid
-        truths, falses = (np.ones(minpars.shape, dtype=bool),
-                          np.zeros(minpars.shape, dtype=bool))
-
-        fixed = falses if fixed is None else fixed
-        limitedmin = truths if limitedmin is None else limitedmin
-        limitedmax = truths if limitedmax is None else limitedmax
-        expand_dict = {'fixed'     : fixed,
-                       'limitedmin': limitedmin,
-                       'limitedmax': limitedmax,
-                       'minpars'   : minpars,
-                       'maxpars'   : maxpars    }
+        expand_dict = self._make_fiteach_args(minpars, maxpars, fixed,
+                                              limitedmin, limitedmax)
 
         for key, val in expand_dict.items():
             expander = np.repeat([expand_dict[key]],
@@ -185,12 +227,50 @@ class SubCube(pyspeckit.Cube):
         self.guess_grid = np.append(self.guess_grid, guess_grid, axis=0)
         return self.guess_grid
 
+    def _make_fiteach_args(self, minpars, maxpars, fixed=None,
+                           limitedmin=None, limitedmax=None):
+        """
+        Bundles parameter limits into a dictionary of keyword arguments
+        for Cube.fiteach, see SubCube.make_guess_grid for details.
+        """
+        truths, falses = (np.ones(minpars.shape, dtype=bool),
+                          np.zeros(minpars.shape, dtype=bool))
+
+        fixed = falses if fixed is None else fixed
+        limitedmin = truths if limitedmin is None else limitedmin
+        limitedmax = truths if limitedmax is None else limitedmax
+        return {'fixed'     : fixed,
+                'limitedmin': limitedmin,
+                'limitedmax': limitedmax,
+                'minpars'   : minpars,
+                'maxpars'   : maxpars    }
+
     def _grid_parspace(self, minpars, maxpars, finesse, clip_edges=True,
-                       spacing=None, npeaks=None, **kwargs):
+                       **kwargs):
         """
         The actual gridding takes place here.
         See SubCube.make_guess_grid for details.
 
+        Parameters are the same as in SubCube._par_space
+        """
+        par_space = self._par_space(minpars, maxpars, finesse,
+                                    clip_edges, **kwargs)
+        npars = minpars.size
+
+        # the cartesian product is written straight into the final layout,
+        # ordered as in guess_grid_rows (the last parameter changes fastest)
+        guess_grid = np.empty(shape=[len(p) for p in par_space] + [npars])
+        for i, values in enumerate(par_space):
+            guess_grid[..., i] = values.reshape([-1 if j == i else 1
+                                                 for j in range(npars)])
+
+        return guess_grid.reshape(-1, npars)
+
+    def _par_space(self, minpars, maxpars, finesse, clip_edges=True,
+                   scale='linear', spacing=None, npeaks=None, **kwargs):
+        """
+        Samples the parameter ranges to be gridded.
+
         Parameters
         ----------
         minpars : np.array containing minimal parameter values
@@ -202,6 +282,14 @@ class SubCube(pyspeckit.Cube):
 
         clip_edges : boolean; if True, the edge values are not
                      included in the guess grid
+
+        scale : 'linear' or 'log', or an iterable of those for every
+                parameter; 'log' samples the range uniformly in log space
+
+        Returns
+        -------
+        par_space : a list of 1d arrays of parameter values,
+                    the guess grid spans all their combinations
         """
         # don't want to go though (often lengthy) model
         # generation just to have fiteach fail, do we?
@@ -212,22 +300,34 @@ class SubCube(pyspeckit.Cube):
         npars = minpars.size
 
         # conformity for finesse: int or np.array goes in and np.array goes out
-        finesse = np.atleast_1d(finesse) * np.ones(npars)
-
-        log.info("Binning the %i-dimensional parameter"
-                 " space into a %s-shaped grid" %
-                 (npars, str(tuple(finesse.astype(int)))))
+        finesse = np.broadcast_to(np.atleast_1d(finesse), (npars,)).astype(int)
+        scale = np.broadcast_to(np.atleast_1d(scale), (npars,))
+        if np.any((scale == 'log') & ((minpars <= 0) | (maxpars <= 0))):
+            raise ValueError("Parameters sampled in log space "
+                             "should have positive ranges.")
+
+        # the grid shape is only formatted if it's going to be shown
+        if log.isEnabledFor(logging.INFO):
+            log.info("Binning the %i-dimensional parameter"
+                     " space into a %s-shaped grid" %
+                     (npars, str(tuple(finesse.tolist()))))
 
         par_space = []
-        for i_len, i_min, i_max in zip(finesse+clip_edges*2, minpars, maxpars):
-            par_slice_1d = (np.linspace(i_min, i_max, i_len) if not clip_edges
-                            else np.linspace(i_min, i_max, i_len)[1:][:-1]
-                           )
+        for i_len, i_min, i_max, i_scale in zip(finesse, minpars,
+                                                maxpars, scale):
+            if i_scale == 'log':
+                i_min, i_max = np.log10(i_min), np.log10(i_max)
+            if clip_edges:
+                # the interior points of an (i_len+2)-point linspace
+                step = (i_max - i_min) / (i_len + 1)
+                par_slice_1d = i_min + step * np.arange(1, i_len + 1)
+            else:
+                par_slice_1d = np.linspace(i_min, i_max, i_len)
+            if i_scale == 'log':
+                par_slice_1d = 10**par_slice_1d
             par_space.append(par_slice_1d)
 
-        nguesses = np.prod(list(map(len,par_space)))
-
-        return np.array(np.meshgrid(*par_space)).reshape(npars, nguesses).T
+        return par_space
 
     def _remove_close_peaks(self, guess_grid=None, spacing=[],
                             which=[], npeaks=2, **kwargs):
@@ -252,6 +352,18 @@ class SubCube(pyspeckit.Cube):
             except AttributeError:
                 raise RuntimeError("Can't find the guess grid to use.")
 
+        return guess_grid[self._close_peaks_mask(guess_grid, spacing,
+                                                 which, npeaks)]
+
+    def _close_peaks_mask(self, guess_grid, spacing=[], which=[], npeaks=2,
+                          **kwargs):
+        """
+        Flags the guesses to be kept by SubCube._remove_close_peaks.
+
+        Returns
+        -------
+        mask : boolean array, True for the guess grid rows to keep
+        """
         if npeaks!=2:
             raise NotImplementedError("WIP, sorry :/")
 
@@ -259,11 +371,28 @@ class SubCube(pyspeckit.Cube):
         spacing, which = np.atleast_1d(spacing), np.atleast_1d(which)
         npars = int(guess_grid.shape[1] / npeaks)
 
+        mask = np.ones(guess_grid.shape[0], dtype=bool)
         # for every parameter space dimension to look into
         for dp, i in zip(spacing, which):
-            m = np.abs(guess_grid[:,i]-guess_grid[:,i+npars]) > dp
-            guess_grid = guess_grid[m]
-        return guess_grid
+            mask &= np.abs(guess_grid[:,i]-guess_grid[:,i+npars]) > dp
+        return mask
+
+    def _model_block(self, guesses, **kwargs):
+        """
+        Runs SubCube.you_shall_not_pass over a block of guesses,
+        passing any keyword arguments, e.g. `cut`, along to it.
+
+        Returns
+        -------
+        models : (N, L)-shaped array of the spectral models
+
+        guesses : (N, M)-shaped array of the guesses used for them
+        """
+        models = np.empty(shape=(guesses.shape[0], self.xarr.size))
+        guesses = np.array(guesses)
+        for i, gg in enumerate(guesses):
+            models[i], guesses[i] = self.you_shall_not_pass(gg, **kwargs)
+        return models, guesses
 
     def you_shall_not_pass(self, gg, cut=None, backup_pars=None, **kwargs):
         """
@@ -276,12 +405,6 @@ class SubCube(pyspeckit.Cube):
         """
         # TODO: seems to work, but needs more testing
         # TODO: the input arguments are ugly, rewrite
-        try:
-            # for multicore > 1
-            kwargs.update(self.you_shall_not_pass_kwargs)
-        except AttributeError:
-            pass
-
         try:
             # some basic progress reporting for multicore > 1
             self.iterticker += 1
@@ -312,7 +435,8 @@ class SubCube(pyspeckit.Cube):
             return tot_model, gg_new
 
     def generate_model(self, guess_grid=None, model_file=None, redo=True,
-                       npeaks=None, multicore=1, **kwargs):
+                       npeaks=None, multicore=1, dtype=None,
+                       memory_limit=None, chunk_size=4096, **kwargs):
         """
         Generates a grid of spectral models matching the
         shape of the input guess_grid array. Can take the
@@ -333,18 +457,34 @@ class SubCube(pyspeckit.Cube):
                      If not set, SubCube.guess_grid is used.
 
         model_file : string; if not None then the models generated will
-                     be saved to an .npy file instead of class attribute
+                     be written straight into a memory-mapped .npy file
+                     instead of a class attribute
 
         redo : boolean; if False and model_file filename is in place, the
                model gird will not be generated anew
 
-        multicore : integer; number of threads to run on (defaults to 1)
+        multicore : integer; number of processes to run on (defaults to 1),
+                    used only for the models that aren't vectorized, and
+                    if there are at least two guesses for every process
+
+        dtype : data type of the model grid, defaults to SubCube.precision
+
+        memory_limit : float; How many gigabytes of RAM the model grid can
+                       take. If it's larger than that, it will be stored
+                       in a memory-mapped temporary file instead. If not
+                       set, the grid is kept in memory regardless of size.
+
+        chunk_size : int; number of models to be generated at a time
 
         Additional keyword arguments are passed to a filter function
         `SubCube.you_shall_not_pass()`
         """
 
-        if not redo and os.path.isfile(model_file):
+        # following the np.save convention for file names
+        if model_file is not None and not model_file.endswith('.npy'):
+            model_file += '.npy'
+
+        if not redo and model_file is not None and os.path.isfile(model_file):
             log.info("A file with generated models is "
                      "already in place. Skipping.")
             return
@@ -364,33 +504,68 @@ class SubCube(pyspeckit.Cube):
             raise ValueError("Invalid shape for the guess_grid, "
                              "check the docsting for details.")
 
-        model_grid = np.empty(shape=grid_shape+(self.xarr.size,))
-        # NOTE: this for loop is the performance bottleneck!
-        # would be nice if I could broadcast guess_grid to n_modelfunc...
+        dtype = dtype or self.precision
+        model_shape = grid_shape+(self.xarr.size,)
+        model_nbytes = np.prod(model_shape)*np.dtype(dtype).itemsize
+        if memory_limit is None and model_file is None:
+            available = get_available_memory()
+            if available and model_nbytes > available:
+                log.warn("The model grid might not fit into the available "
+                         "memory, consider setting either model_file or "
+                         "memory_limit to store it on disk instead.")
+
+        if model_file is not None:
+            model_grid = np.lib.format.open_memmap(model_file, mode='w+',
+                                                   dtype=dtype,
+                                                   shape=model_shape)
+        elif memory_limit and model_nbytes > memory_limit * 2**30:
+            log.info("The model grid is too large to fit in memory, "
+                     "it will be stored in a temporary file instead.")
+            # the file is removed as soon as the memmap is closed
+            model_grid = np.memmap(tempfile.TemporaryFile(), mode='w+',
+                                   dtype=dtype, shape=model_shape)
+        else:
+            model_grid = np.empty(shape=model_shape, dtype=dtype)
         log.info("Generating spectral models from the guess grid . . .")
 
-        if multicore > 1:
-            # python < 3.3 doesn't handle pooling kwargs (via starmap)
+        # analytic models are broadcast over the whole guess grid at once;
+        # the amplitude filter from you_shall_not_pass can alter the
+        # guesses, so it goes through the slow lane instead
+        model_func = self._vectorized_model()
+        if model_func is not None and kwargs.get('cut') is None:
+            flat_guesses = guess_grid.reshape(-1, guess_grid.shape[-1])
+            flat_models = model_grid.reshape(-1, self.xarr.size)
+            for i0 in range(0, flat_guesses.shape[0], chunk_size):
+                i1 = i0 + chunk_size
+                model_func(self._xarr_np, flat_guesses[i0:i1],
+                           out=np.asarray(flat_models[i0:i1]))
+        elif multicore > 1 and np.prod(grid_shape) >= 2 * multicore:
+            flat_guesses = guess_grid.reshape(-1, guess_grid.shape[-1])
             self.iterticker = 0
-            self.itertotal = model_grid.shape[0]/multicore
-            self.you_shall_not_pass_kwargs = kwargs
-
-            # pooling processes, collecting into a list
-            result = pyspeckit.cubes.parallel_map(self.you_shall_not_pass,
-                                            guess_grid, numcores=multicore)
+            self.itertotal = flat_guesses.shape[0]/multicore
+
+            # every process gets a contiguous block of the guess grid and
+            # sends back all of its models at once, instead of pickling
+            # them through the queue one at a time
+            blocks = [(b[0], b[-1] + 1) for b in np.array_split(
+                np.arange(flat_guesses.shape[0]), multicore)]
+            result = pyspeckit.cubes.parallel_map(
+                lambda b: self._model_block(flat_guesses[b[0]:b[1]],
+                                            **kwargs),
+                blocks, numcores=multicore)
             print('') # those progress dots didn't have a concluding newline
 
-            for idx, r in enumerate(result):
-                # make sure the order is preserved, for mutliprocessing is
-                # truly an arcane art (shouldn't eat too much time)
-                assert (guess_grid[idx]==r[1]).all()
-                model_grid[idx] = r[0]
+            flat_models = model_grid.reshape(-1, self.xarr.size)
+            for (i0, i1), (models, guesses) in zip(blocks, result):
+                flat_models[i0:i1] = models
+                # the amplitude filter could have replaced some guesses
+                flat_guesses[i0:i1] = guesses
 
-            # cleaning up kwargs taken for the ride
-            del self.you_shall_not_pass_kwargs
+            # cleaning up the progress counters
             del self.iterticker
             del self.itertotal
         else:
+            # NOTE: this for loop is the performance bottleneck!
             with ProgressBar(model_grid.shape[0]) as bar:
                 for idx in np.ndindex(grid_shape):
                     model_grid[idx], gg = self.you_shall_not_pass(
@@ -400,16 +575,20 @@ class SubCube(pyspeckit.Cube):
                     bar.update()
 
         if model_file is not None:
-            np.save(model_file, model_grid)
+            model_grid.flush()
         else:
             self.model_grid = model_grid
 
-    def best_guess(self, model_grid=None, sn_cut=None, pbar_inc=1000,
+    def best_guess(self, model_grid=None, sn_cut=None,
                    memory_limit=None, model_file=None,
-                   np_load_kwargs={}, **kwargs):
+                   np_load_kwargs={}, chunk_size=4096, **kwargs):
         """
         For a grid of initial guesses, determine the optimal one based
         on the preliminary residual of the specified spectral model.
+        The residuals are computed in SubCube.precision data type, pass
+        precision='float64' to SubCube for a double precision selection.
+        Masked and non-finite channels are left out of the residuals, and
+        the pixels without any data are given NaN guesses.
 
         Parameters
         ----------
@@ -422,26 +601,32 @@ class SubCube(pyspeckit.Cube):
         sn_cut : float; do not consider model selection for pixels
                  below this signal-to-noise ratio cutoff.
 
-        pbar_inc : int; Number of steps in which the progress bar is
-                   updated. The default should be sensible for modern
-                   machines. Prevents the progress bar from consiming
-                   too much computational power.
-
         memory_limit : float; How many gigabytes of RAM could be used for
-                       broadcasting. If estimated usage goes over this
-                       number, best_guess switches to a slower method.
+                       the residuals of a single chunk of models. If set,
+                       the chunk_size is chosen to fit into this limit.
 
         model_file : string; if not None then the models grid will be
                      read from a file using np.load, which additional
                      arguments, like mmap_mode, passed along to it
 
         np_load_kwargs : extra keyword arguments to be passed along to
-                         np.load - see its docstring for more info
+                         np.load - see its docstring for more info. The
+                         file is memory-mapped in read-only mode unless
+                         another mmap_mode is given here.
+
+        chunk_size : int; number of models to compare to the cube at a time,
+                     only one such chunk of a memory-mapped model grid has
+                     to be read into memory at once. Ignored if the
+                     memory_limit is set.
 
         Output
         ------
-        best_guesses : a cube of best models corresponding to xy-grid
-                       (saved as a SubCube attribute)
+        best_guesses : a cube of best models corresponding to xy-grid,
+                       chosen by the least sum of squared residuals
+                       (saved as a SubCube attribute). The residuals
+                       themselves are reported as root mean squares in
+                       the SubCube._best_rmsmap attribute, which ranks
+                       the models in the same order.
 
         best_guess : a most commonly found best guess
 
@@ -451,6 +636,11 @@ class SubCube(pyspeckit.Cube):
         """
         if model_grid is None:
             if model_file is not None:
+                # following the np.save convention for file names
+                if not model_file.endswith('.npy'):
+                    model_file += '.npy'
+                # only the chunk of models being compared is read from disk
+                np_load_kwargs = dict({'mmap_mode': 'r'}, **np_load_kwargs)
                 model_grid = np.load(model_file, **np_load_kwargs)
                 self.model_grid = model_grid
             elif self.model_grid is None:
@@ -466,127 +656,188 @@ class SubCube(pyspeckit.Cube):
         if len(model_grid.shape)>2:
             raise NotImplementedError("Complex model girds aren't supported.")
 
+        if sn_cut:
+            snr_mask = self.snr_map > sn_cut
+        else:
+            snr_mask = np.ones(shape=self.cube.shape[1:], dtype=bool)
+
+        # NOTE: instead of broadcasting the model grid to the cube,
+        #       the squared residuals are computed through BLAS matrix
+        #       products, one for every chunk of the model grid, and only
+        #       the least ones found so far are kept for every pixel.
+        #       Pixels below the S/N cut are not considered at all.
+        valid, D, d2, W, nchan = self._residual_data(snr_mask)
+        if memory_limit:
+            # a chunk of models and its (chunk, P) matrix of residuals
+            itemsize = np.dtype(self.precision).itemsize
+            chunk_size = max(1, int(memory_limit * 2**30 // (itemsize *
+                                    (D.shape[0] + 2 * D.shape[1]))))
+
+        best_ssr = np.full(D.shape[1], np.inf, dtype=self.precision)
+        best_idx = np.zeros(D.shape[1], dtype=int)
+        nmodels = model_grid.shape[0]
         log.info("Calculating residuals for generated models . . .")
+        with ProgressBar(nmodels) as bar:
+            for i0 in range(0, nmodels, chunk_size):
+                i1 = min(i0 + chunk_size, nmodels)
+                M = np.asarray(model_grid[i0:i1], dtype=self.precision)
+                update_best_residuals(squared_residuals(M, D, d2, W=W),
+                                      np.arange(i0, i1), best_ssr, best_idx)
+                bar.update(i1)
+
+        best_map = np.full(self.cube.shape[1:], np.nan)
+        rmsmin_map = np.full(self.cube.shape[1:], np.nan)
+        best_map[valid] = best_idx
+        # sqrt(ssr/L) is monotonic in ssr, so it's only taken for the
+        # best models; rounding errors can make a perfect match negative
+        rmsmin_map[valid] = np.sqrt(best_ssr.clip(min=0) / nchan)
+
+        self._set_best_guesses(best_map, rmsmin_map, valid)
+
+    def make_best_guess_streaming(self, minpars, maxpars, finesse,
+                                  sn_cut=None, chunk_size=1024, fixed=None,
+                                  limitedmin=None, limitedmax=None, **kwargs):
+        """
+        A low-memory equivalent of running SubCube.make_guess_grid,
+        SubCube.generate_model, and SubCube.best_guess in a row.
 
-        try: # TODO: move this out into an astro_toolbox function
-            import psutil
-            mem = psutil.virtual_memory().available
-        except ImportError:
-            import os
-            try:
-                memgb = os.popen("free -g").readlines()[1].split()[3]
-            except IndexError: # would happen on Macs/Windows
-                memgb = 8
-                log.warn("Can't get the free RAM "
-                         "size, assuming %i GB" % memgb)
-            memgb = memory_limit or memgb
-            mem = int(memgb) * 2**30
+        The models are generated for one chunk of the guess grid at a
+        time, compared to the cube right away, and then discarded. Only
+        the least sum of squared residuals found so far is kept for every
+        pixel, so the full (N, L)-shaped model grid is never stored. The
+        guesses are computed chunk by chunk as well, and SubCube.guess_grid
+        is only populated with the guesses that ended up being the best
+        ones. Any previously generated SubCube.model_grid is discarded.
+
+        Parameters
+        ----------
+        minpars, maxpars, finesse, fixed, limitedmin, limitedmax :
+            see SubCube.make_guess_grid
+
+        sn_cut : float; do not consider model selection for pixels
+                 below this signal-to-noise ratio cutoff.
+
+        chunk_size : int; number of models to be held in memory at once
+
+        Additional keyword arguments, like clip_edges and scale, are passed
+        to SubCube._par_space, and spacing, which, and npeaks are passed to
+        SubCube._close_peaks_mask, as in SubCube.make_guess_grid.
 
+        Raises a ValueError if no pixel passes the S/N cut.
+        """
         if sn_cut:
             snr_mask = self.snr_map > sn_cut
         else:
             snr_mask = np.ones(shape=self.cube.shape[1:], dtype=bool)
+        valid, D, d2, W, nchan = self._residual_data(snr_mask)
+        # no winning guesses would be left to make the guess grid from
+        if not valid.any():
+            raise ValueError("No pixels with data above the S/N cut of %s, "
+                             "nothing to choose the guesses for." % sn_cut)
+
+        minpars, maxpars = np.asarray([minpars, maxpars])
+        self.fiteach_args = self._make_fiteach_args(minpars, maxpars, fixed,
+                                                    limitedmin, limitedmax)
+        par_space = self._par_space(minpars, maxpars, finesse, **kwargs)
+        nguesses = np.prod([len(p) for p in par_space])
+
+        best_ssr = np.full(D.shape[1], np.inf, dtype=self.precision)
+        best_idx = np.zeros(D.shape[1], dtype=int)
+        model_func = self._vectorized_model()
+        log.info("Selecting the best guesses in chunks of %i "
+                 "models . . ." % chunk_size)
+        with ProgressBar(nguesses) as bar:
+            for i0 in range(0, nguesses, chunk_size):
+                i1 = min(i0 + chunk_size, nguesses)
+                rows = np.arange(i0, i1)
+                guess_chunk = guess_grid_rows(par_space, rows)
+                keep = self._close_peaks_mask(guess_chunk, **kwargs)
+                rows, guess_chunk = rows[keep], guess_chunk[keep]
+                bar.update(i1)
+                if not rows.size:
+                    continue
 
-        # allow for 50% computational overhead
-        threshold = self.cube.nbytes*model_grid.shape[0]*2
-        if mem < threshold:
-            log.warn("The available free memory might not be enough for "
-                     "broadcasting model grid to the spectral cube. Will "
-                     "iterate over all the XY pairs instead. Coffee time!")
+                M = np.empty(shape=(rows.size, self.xarr.size),
+                             dtype=self.precision)
+                if model_func is not None:
+                    model_func(self._xarr_np, guess_chunk, out=M)
+                else:
+                    for i, gg in enumerate(guess_chunk):
+                        M[i] = self.specfit.get_full_model(pars=gg)
 
-            try:
-                if type(model_grid) is not np.ndarray: # assume memmap type
-                    raise MemoryError("This will take ages, skipping to "
-                                      "the no-broadcasting scenario.")
-                # NOTE: this below is a monument to how things should *not*
-                #       be done. Seriously, trying to broadcast 1.5M models
-                #       to a 400x200 map can result in 700GB of RAM needed!
-                #residual_rms = np.empty(shape=((model_grid.shape[0],)
-                #                               + self.cube.shape[1:]))
-                #with ProgressBar(np.prod(self.cube.shape[1:])) as bar:
-                #    for (y,x) in np.ndindex(self.cube.shape[1:]):
-                #        residual_rms[:,y,x] = (self.cube[None,:,y,x]
-                #                               - model_grid).std(axis=1)
-                #        bar.update()
-
-                best_map = np.full(self.cube.shape[1:], np.nan)
-                rmsmin_map = np.full(self.cube.shape[1:], np.nan)
-                with ProgressBar(np.prod(self.cube.shape[1:])) as bar:
-                    for (y, x) in np.ndindex(self.cube.shape[1:]):
-                        if not np.isfinite(self.cube[:, y, x]).any():
-                            bar.update()
-                            continue
-                        if sn_cut:
-                            if not snr_mask[y, x]:
-                                best_map[y, x], rmsmin_map[y,
-                                                           x] = np.nan, np.nan
-                                bar.update()
-                                continue
-                        resid_rms_xy = (np.nanstd(
-                            model_grid - self.cube[None, :, y, x], axis=1))
-                        best_map[y, x] = np.argmin(resid_rms_xy)
-                        rmsmin_map[y, x] = np.nanmin(resid_rms_xy)
-                        bar.update()
-            except MemoryError:  # catching memory errors could be really bad!
-                log.warn("Not enough memory to broadcast model grid to the "
-                         "XY grid. This is bad for a number of reasons, the "
-                         "foremost of which: the running time just went "
-                         "through the roof. Leave it overnight maybe?")
-                best_map = np.full(self.cube.shape[1:], np.nan)
-                rmsmin_map = np.full(self.cube.shape[1:], np.nan)
-                # TODO: this takes ages! refactor this through hdf5
-                # "chunks" of acceptable size, and then broadcast them!
-                with ProgressBar(
-                        np.prod((model_grid.shape[0], ) + self.cube.shape[
-                            1:])) as bar:
-                    for (y, x) in np.ndindex(self.cube.shape[1:]):
-                        if not np.isfinite(self.cube[:, y, x]).any():
-                            bar.update(bar._current_value +
-                                       model_grid.shape[0])
-                            continue
-                        if sn_cut:
-                            if not snr_mask[y, x]:
-                                best_map[y, x], rmsmin_map[y,
-                                                           x] = np.nan, np.nan
-                                bar.update(bar._current_value +
-                                           model_grid.shape[0])
-                                continue
-                        resid_rms_xy = np.empty(shape=model_grid.shape[0])
-                        for model_id in np.ndindex(model_grid.shape[0]):
-                            resid_rms_xy[model_id] = (
-                                self.cube[:, y, x] - model_grid[model_id]
-                            ).std()
-                            if not model_id[0] % pbar_inc:
-                                bar.update(bar._current_value + pbar_inc)
-                        best_map[y, x] = np.argmin(resid_rms_xy)
-                        rmsmin_map[y, x] = np.nanmin(resid_rms_xy)
-        else:
-            # NOTE: broadcasting below is a much faster way to compute
-            #       cube - model residuals. But for big model sizes this
-            #       will cause memory overflows.
-            #       The code above tried to catch this before it happens
-            #       and run things in a slower fashion.
-            residual_rms = (
-                self.cube[None, :, :, :] - model_grid[:, :, None, None]).std(
-                    axis=1)
-            if sn_cut:
-                zlen = residual_rms.shape[0]
-                residual_rms[~self.get_slice_mask(snr_mask, zlen)] = np.inf
+                update_best_residuals(squared_residuals(M, D, d2, W=W),
+                                      rows, best_ssr, best_idx)
 
-            try:
-                best_map = np.argmin(residual_rms, axis=0)
-                rmsmin_map = residual_rms.min(axis=0)
-            except MemoryError:
-                log.warn("Not enough memory to compute the minimal"
-                         " residuals, will iterate over XY pairs.")
-                best_map = np.empty_like(self.cube[0], dtype=int)
-                rmsmin_map = np.empty_like(self.cube[0])
-                with ProgressBar(np.prod(best_map.shape)) as bar:
-                    for (y, x) in np.ndindex(best_map.shape):
-                        best_map[y, x] = np.argmin(residual_rms[:, y, x])
-                        rmsmin_map[y, x] = residual_rms[:, y, x].min()
-                        bar.update()
+        # only the guesses that won somewhere are kept in the guess grid;
+        # a model grid made earlier no longer matches it, so it's dropped
+        best_rows, best_idx = np.unique(best_idx, return_inverse=True)
+        self.guess_grid = guess_grid_rows(par_space, best_rows)
+        self.model_grid = None
+        self.fiteach_arg_grid = {key: np.repeat([val], best_rows.size,
+                                 axis=0) for key, val in
+                                 self.fiteach_args.items()}
+
+        best_map = np.full(self.cube.shape[1:], np.nan)
+        rmsmin_map = np.full(self.cube.shape[1:], np.nan)
+        best_map[valid] = best_idx
+        rmsmin_map[valid] = np.sqrt(best_ssr.clip(min=0) / nchan)
+        self._set_best_guesses(best_map, rmsmin_map, valid)
+
+    def _vectorized_model(self):
+        """
+        Looks up a function that evaluates the current model for a whole
+        guess grid at once, see `vectorized_models` for the available ones.
+
+        Returns
+        -------
+        model_func : callable with the signature of gaussian_model_grid,
+                     or None if there isn't one for this fittype
+        """
+        return vectorized_models.get(getattr(self, 'fittype', None))
+
+    def _residual_data(self, snr_mask):
+        """
+        Prepares the spectra for a comparison against the model grid.
+
+        Masked and non-finite channels are left out of the comparison:
+        they are zeroed in the spectra and given zero weight in W. Pixels
+        without a single finite channel are not valid.
+
+        Returns
+        -------
+        valid : a (Y, X)-shaped mask of the pixels within `snr_mask`
+                that have at least one finite channel
 
+        D : an (L, P)-shaped array of the P valid spectra,
+            cast to SubCube.precision
+
+        d2 : P squared norms of the spectra in D
+
+        W : an (L, P)-shaped array of channel weights, one for the channels
+            with data and zero otherwise, or None if all of them have data
+
+        nchan : number of channels with data, for every valid spectrum
+        """
+        # one spectrum per row, so that both the selection of
+        # valid pixels and the norms run over contiguous memory
+        flat_cube = self._get_cube_flat_T(self.precision)
+        finite = np.isfinite(flat_cube)
+        valid = snr_mask & finite.any(axis=1).reshape(snr_mask.shape)
+        D = flat_cube if valid.all() else flat_cube[valid.ravel()]
+        finite = finite if valid.all() else finite[valid.ravel()]
+        if finite.all():
+            W, nchan = None, np.full(D.shape[0], D.shape[1])
+        else:
+            D = np.where(finite, D, 0).astype(self.precision)
+            W, nchan = finite.astype(self.precision).T, finite.sum(axis=1)
+        return valid, D.T, np.einsum('ij,ij->i', D, D), W, nchan
+
+    def _set_best_guesses(self, best_map, rmsmin_map, valid):
+        """
+        Stores the best guesses and their residuals, along with the
+        overall best guess, from a map of best model indices.
+        The guesses are set to NaN for the pixels outside `valid`.
+        """
         # indexing by nan values would cause an IndexError
         best_nan = np.isnan(best_map)
         best_map[np.isnan(best_map)] = 0
@@ -595,8 +846,8 @@ class SubCube(pyspeckit.Cube):
         self._best_map = best_map_int
         self._best_rmsmap = rmsmin_map
         self.best_guesses = np.rollaxis(self.guess_grid[best_map_int], -1)
-        snrmask3d = np.repeat([snr_mask], self.best_guesses.shape[0], axis=0)
-        self.best_guesses[~snrmask3d] = np.nan
+        # the 2d mask is broadcast along the parameter axis
+        self.best_guesses[:, ~valid] = np.nan
         try:
             self.best_fitargs = {
                 key: np.rollaxis(self.fiteach_arg_grid[key][best_map_int],-1)
@@ -606,10 +857,11 @@ class SubCube(pyspeckit.Cube):
             log.warn("SubCube.fiteach_arg_grid has a different shape than"
                      " the one used. SubCube.best_fitargs won't be generated.")
 
-        from scipy.stats import mode
-        model_mode = mode(best_map)
-        best_model_num = int(model_mode[0][0, 0])
-        best_model_freq = model_mode[1][0, 0]
+        # the most common best model among the pixels that have one
+        counts = np.bincount(best_map_int[~best_nan],
+                             minlength=self.guess_grid.shape[0])
+        best_model_num = int(counts.argmax())
+        best_model_freq = counts[best_model_num]
         best_model_frac = (float(best_model_freq) /
                            np.prod(self.cube.shape[1:]))
         if best_model_frac < .05:
@@ -630,6 +882,84 @@ class SubCube(pyspeckit.Cube):
             log.warn("Can't find the SNR map, best guess at "
                      "highest SNR pixel will not be stored.")
 
+    def cluster_guesses(self, k=32, random_state=None, **kwargs):
+        """
+        Refines the map of best guesses by grouping similar guesses
+        together. The guesses are clustered with k-means, the mean spectrum
+        of every cluster is then fit once with the cluster centroid as an
+        initial guess, and the fitted parameters are used as a shared prior
+        for all the pixels in the cluster. Requires scikit-learn.
+
+        Parameters
+        ----------
+        k : int; number of clusters
+
+        random_state : passed along to sklearn.cluster.MiniBatchKMeans
+
+        Additional keyword arguments are passed to the fitter, and take
+        precedence over the ones stored in SubCube.fiteach_args
+
+        Returns
+        -------
+        cluster_priors : an (M, Y, X)-shaped cube of refined guesses,
+                         also stored under SubCube.cluster_priors
+        """
+        from sklearn.cluster import MiniBatchKMeans
+
+        npars = self.best_guesses.shape[0]
+        guesses = self.best_guesses.reshape(npars, -1).T
+        ok_idx = np.flatnonzero(np.isfinite(guesses).all(axis=1))
+        if not ok_idx.size:
+            raise ValueError("No valid best guesses to cluster.")
+        # the parameters are rescaled to the unit range, otherwise the
+        # ones with the largest spread (e.g., centroids) would dominate
+        try:
+            offset = np.asarray(self.fiteach_args['minpars'], dtype=float)
+            scale = (np.asarray(self.fiteach_args['maxpars'], dtype=float)
+                     - offset)
+        except (AttributeError, KeyError):
+            offset = guesses[ok_idx].min(axis=0)
+            scale = np.ptp(guesses[ok_idx], axis=0)
+        scale = np.where(scale > 0, scale, 1.)
+
+        kmeans = MiniBatchKMeans(n_clusters=min(k, ok_idx.size),
+                                 random_state=random_state)
+        labels = kmeans.fit_predict((guesses[ok_idx] - offset) / scale)
+        centroids = kmeans.cluster_centers_ * scale + offset
+
+        priors = np.full_like(guesses, np.nan)
+        ys, xs = np.unravel_index(ok_idx, self.cube.shape[1:])
+        log.info("Fitting the mean spectra of %i guess "
+                 "clusters . . ." % kmeans.n_clusters)
+        for label, centroid in enumerate(centroids):
+            members = labels == label
+            if not members.any():
+                continue
+            y, x = ys[members][0], xs[members][0]
+            sp = self.get_spectrum(x, y)
+            sp.specfit.Registry = self.Registry
+            sp.data = self.cube[:, ys[members], xs[members]].mean(axis=1)
+            if hasattr(self, '_rms_map'):
+                rms = np.nanmedian(self._rms_map[ys[members], xs[members]])
+                sp.error = np.ones(sp.data.shape) * rms / np.sqrt(members.sum())
+            else:
+                sp.error = np.ones(sp.data.shape) * sp.data.std()
+
+            fitkwargs = (self._unpack_fitkwargs(x, y)
+                         if hasattr(self, 'fiteach_args') else {})
+            fitkwargs.update(kwargs)
+            try:
+                sp.specfit(fittype=self.fittype, guesses=list(centroid),
+                           quiet=True, verbose=False, **fitkwargs)
+                priors[ok_idx[members]] = sp.specfit.modelpars
+            except Exception as ex:
+                log.warn("Fit for the guess cluster #%i failed on error %s, "
+                         "using its centroid instead." % (label, str(ex)))
+                priors[ok_idx[members]] = centroid
+
+        self.cluster_priors = priors.T.reshape(self.best_guesses.shape)
+        return self.cluster_priors
+
     def get_slice_mask(self, mask2d, notxarr=None):
         """
         In case we ever want to apply a 2d mask to a whole cube.
@@ -638,9 +968,15 @@ class SubCube(pyspeckit.Cube):
         ----------
         notxarr : if set, will be used as a length of a 3rd dim;
                   Otherwise, size of self.xarr is used.
+
+        Returns
+        -------
+        mask3d : a read-only view of mask2d repeated along the first axis,
+                 call np.array on it if a writeable copy is needed
         """
         zlen = notxarr if notxarr else self.xarr.size
-        mask3d = np.repeat([mask2d], zlen, axis=0)
+        mask2d = np.asarray(mask2d)
+        mask3d = np.broadcast_to(mask2d[None, ...], (zlen,) + mask2d.shape)
         return mask3d
 
     def get_snr_map(self, signal=None, noise=None, unit='km/s',
@@ -708,40 +1044,65 @@ class SubCube(pyspeckit.Cube):
         self._mask_noise = noise_mask
 
         # no need to care about units at this point
-        snr_map = (self.get_signal_map(signal_mask)
-                   / self.get_rms_map(noise_mask))
+        snr_map = self._compute_maps(signal_mask, noise_mask)
         self.snr_map = snr_map
         return snr_map
 
+    def _compute_maps(self, signal_mask, noise_mask):
+        """
+        Gets the signal, rms, and S/N maps at once. With numba installed,
+        the peak signal and the rms are taken in one pass through the cube;
+        otherwise, or for masked cubes, SubCube.get_signal_map and
+        SubCube.get_rms_map are used.
+
+        Returns
+        -------
+        snr_map : numpy.array; signal and rms maps are stored under
+                  SubCube._signal_map and SubCube._rms_map
+        """
+        signal_idx = np.flatnonzero(signal_mask)
+        noise_idx = np.flatnonzero(noise_mask)
+        # masked or non-native arrays go the numpy way
+        if (signal_idx.size and noise_idx.size
+                and _kernels.accepts(self.cube)):
+            signal_map = np.empty(self.cube.shape[1:], dtype=self.cube.dtype)
+            rms_map = np.empty_like(signal_map)
+            _kernels.snr_maps(self.cube, signal_idx, noise_idx,
+                              signal_map, rms_map)
+            self._signal_map, self._rms_map = signal_map, rms_map
+        else:
+            signal_map = self.get_signal_map(signal_mask)
+            rms_map = self.get_rms_map(noise_mask)
+
+        return signal_map / rms_map
+
     def get_mask(self, low_indices, high_indices, unit):
         """
         Converts low / high indices arrays into a mask on self.xarr
         """
         mask = np.array([False]*self.xarr.size)
-        for low, high in zip(low_indices, high_indices):
-            # you know this is a hack right?
-            # also, undocumented functionality is bad and you should feel bad
-            if unit not in ['pix','pixel','pixels','chan','channel','channels']:
-                # converting whatever units we're given to pixels
-                unit_low, unit_high = low*u.Unit(unit), high*u.Unit(unit)
-                try:
-                    # FIXME: this is too slow, find a better way!
-                    unit_bkp = self.xarr.unit
-                    self.xarr.convert_to_unit(unit)
-                except u.core.UnitConversionError as err:
-                    raise type(err)(str(err) + "\nConsider setting, e.g.:\n"
-                            "SubCube.xarr.velocity_convention = 'radio'\n"
-                            "and\nSubCube.xarr.refX = line_freq*u.GHz")
-                index_low  = self.xarr.x_to_pix(unit_low)
-                index_high = self.xarr.x_to_pix(unit_high)
-                self.xarr.convert_to_unit(unit_bkp)
-            else:
-                try:
-                    index_low, index_high = (int(low.value ),
-                                             int(high.value))
-                except AttributeError:
-                    index_low, index_high = int(low), int(high)
+        # you know this is a hack right?
+        # also, undocumented functionality is bad and you should feel bad
+        if unit not in ['pix','pixel','pixels','chan','channel','channels']:
+            # converting whatever units we're given to pixels, without
+            # touching the units of the spectral axis itself
+            try:
+                xarr_values = self.xarr.as_unit(unit).value
+            except u.core.UnitConversionError as err:
+                raise type(err)(str(err) + "\nConsider setting, e.g.:\n"
+                        "SubCube.xarr.velocity_convention = 'radio'\n"
+                        "and\nSubCube.xarr.refX = line_freq*u.GHz")
+            indices_low = nearest_channels(xarr_values,
+                            u.Quantity(low_indices, unit).value)
+            indices_high = nearest_channels(xarr_values,
+                            u.Quantity(high_indices, unit).value)
+        else:
+            indices_low, indices_high = (
+                np.asarray(u.Quantity(low_indices).value, dtype=int),
+                np.asarray(u.Quantity(high_indices).value, dtype=int))
 
+        for index_low, index_high in zip(np.atleast_1d(indices_low),
+                                         np.atleast_1d(indices_high)):
             # so this also needs to be sorted if the axis goes in reverse
             index_low, index_high = np.sort([index_low, index_high])
 
@@ -755,6 +1116,10 @@ class SubCube(pyspeckit.Cube):
         the input values or in class instances. If noise mask is not
         not given, defaults to calculating rms of all channels.
 
+        The rms is estimated from the median absolute deviation of the
+        noise channels, so that the stray signal leaking into them does
+        not inflate the noise level.
+
         Parameters
         ----------
         noise_mask : dtype=bool numpy.array of SubCube.xarr size
@@ -768,7 +1133,13 @@ class SubCube(pyspeckit.Cube):
             log.warn('no noise mask was given, will calculate the RMS '
                      'over all channels, thus overestimating the noise!')
             noise_mask = np.ones(self.xarr.shape, dtype=bool)
-        rms_map = self.cube[noise_mask,:,:].std(axis=0)
+        runs = channel_runs(noise_mask)
+        if len(runs) == 1:
+            # a single block of channels can be passed along as a view
+            noise_cube = self.cube[runs[0, 0]:runs[0, 1]]
+        else:
+            noise_cube = self.cube.take(np.flatnonzero(noise_mask), axis=0)
+        rms_map = mad_std(noise_cube, axis=0)
         self._rms_map = rms_map
         return rms_map
 
@@ -789,8 +1160,14 @@ class SubCube(pyspeckit.Cube):
         if signal_mask is None:
             log.warn('no signal mask was given, will calculate the signal '
                      'over all channels: true signal might be lower.')
-            signal_mask = np.array(self.xarr.shape, dtype=bool)
-        signal_map = self.cube[signal_mask,:,:].max(axis=0)
+            signal_mask = np.ones(self.xarr.shape, dtype=bool)
+        # reducing over views of contiguous channel blocks, so that
+        # the signal channels are never copied out of the cube
+        signal_map = None
+        for start, stop in channel_runs(signal_mask):
+            block_max = self.cube[start:stop].max(axis=0)
+            signal_map = (block_max if signal_map is None
+                          else np.maximum(signal_map, block_max))
         self._signal_map = signal_map
         return signal_map
 
@@ -804,7 +1181,36 @@ class SubCube(pyspeckit.Cube):
         if sigma is None:
             sigma = self._rms_map
 
-        chisq = ((self.cube - self._modelcube)**2 / sigma**2).sum(axis=0)
+        # residuals are made for a block of channels at a time, so that
+        # the temporary arrays never grow to the size of the whole cube
+        nchan = self.cube.shape[0]
+        nblock = max(1, 2**22 // int(np.prod(self.cube.shape[1:])))
+        if np.ndim(sigma) == 3:
+            # errors vary along the spectral axis, so they are
+            # folded into the residuals before squaring them
+            chisq = np.zeros(self.cube.shape[1:])
+            for k0 in range(0, nchan, nblock):
+                k1 = k0 + nblock
+                resid = ((self.cube[k0:k1] - self._modelcube[k0:k1])
+                         / sigma[k0:k1])
+                # einsum ignores masks, masked channels shouldn't count
+                resid = np.ma.filled(resid, 0)
+                chisq += np.einsum('lyx,lyx->yx', resid, resid)
+        else:
+            # the squared residuals are summed up in a single pass,
+            # and only then scaled by the (per-pixel) noise level
+            if _kernels.accepts(self.cube, self._modelcube):
+                ssr = np.empty(self.cube.shape[1:])
+                _kernels.residual_ssr(self.cube, self._modelcube, ssr)
+            else:
+                ssr = np.zeros(self.cube.shape[1:])
+                for k0 in range(0, nchan, nblock):
+                    k1 = k0 + nblock
+                    resid = self.cube[k0:k1] - self._modelcube[k0:k1]
+                    # einsum ignores masks, masked channels shouldn't count
+                    resid = np.ma.filled(resid, 0)
+                    ssr += np.einsum('lyx,lyx->yx', resid, resid)
+            chisq = ssr / sigma**2
 
         self.chi_squared = chisq
         return chisq
@@ -842,7 +1248,7 @@ class SubCube(pyspeckit.Cube):
 
         # NOTE: for some reason get_modelcube returns zeros for some
         #       pixels even if corresponding Cube.parcube[:,y,x] is NaN
-        prob_chisq[np.isnan(self.parcube.min(axis=0))] = np.nan
+        prob_chisq[np.isnan(self.parcube).any(axis=0)] = np.nan
 
         if plot_chisq:
             if not plt.rcParams['text.usetex']:
@@ -869,11 +1275,14 @@ class SubCube(pyspeckit.Cube):
         the method tries to get its own guess from:
         self.prob_chisq < cut
 
-        Additional keyword arguments are passed to plt.plot.
+        Additional keyword arguments are passed to LineCollection.
         """
         # setting defaults for plotting if no essentials are passed
         ax = ax or self.mapplot.axis
-        pltkwargs = {'alpha': 0.8, 'ls': '--', 'lw': 1.5, 'c': 'r'}
+        pltkwargs = {'alpha': 0.8, 'ls': '--', 'lw': 1.5, 'color': 'r'}
+        # plt.plot shorthand that collections don't understand
+        if 'c' in kwargs:
+            kwargs['color'] = kwargs.pop('c')
         pltkwargs.update(kwargs)
         # because the plotting routine would attempt to change the scale
         try:
@@ -891,33 +1300,41 @@ class SubCube(pyspeckit.Cube):
 
         # that +1 modifier is there because of aplpy's
         # convention on the (0,0) origin in FITS files
-        for y,x in np.stack(np.where(mask)).T+1:
-            self._doodle_xy(ax, (x,y), method, **pltkwargs)
+        y, x = np.where(mask)
+        self._doodle_xy(ax, (x+1, y+1), method, **pltkwargs)
 
     def _doodle_xy(self, ax, xy, method, **kwargs):
         """
-        Draws lines on top of a pixel.
+        Draws lines on top of pixels, all of them added
+        to the axis as a single LineCollection.
 
         Parameters
         ----------
         ax : axis to doodle on
 
-        xy : a tuple of xy coordinate pair
+        xy : a tuple of xy coordinates, either a pair
+             of numbers or a pair of same-sized arrays
 
         method : what to draw. 'box' and 'cross' are supported
         """
+        from matplotlib.collections import LineCollection
+
         # TODO: if ax is None take it from self.mapplot.axis
-        x, y = xy
-        if method is 'box':
-            ax.plot([x-.5,x-.5,x+.5,x+.5,x-.5],
-                    [y-.5,y+.5,y+.5,y-.5,y-.5],
-                    **kwargs)
-        elif method is 'cross':
-            ax.plot([x-.5,x+.5], [y-.5,y+.5], **kwargs)
-            ax.plot([x+.5,x-.5], [y-.5,y+.5], **kwargs)
+        x, y = np.atleast_1d(*xy)
+        x, y = x[:, None], y[:, None]
+        if method == 'box':
+            # one closed polyline per pixel
+            lines = np.stack([x + [-.5, -.5, .5, .5, -.5],
+                              y + [-.5, .5, .5, -.5, -.5]], axis=-1)
+        elif method == 'cross':
+            # two diagonal line segments per pixel
+            lines = np.stack([x + [-.5, .5, .5, -.5],
+                              y + [-.5, .5, -.5, .5]], axis=-1)
+            lines = lines.reshape(-1, 2, 2)
         else:
             raise ValueError("unknown method %s passed to "
                              "the doodling function" % method)
+        ax.add_collection(LineCollection(lines, **kwargs))
 
     def _doodle_box(self, ax, xy1, xy2, **kwargs):
         """
@@ -1003,13 +1420,14 @@ class SubCube(pyspeckit.Cube):
     def fiteach(self, errmap=None, snrmap=None, guesses=(), verbose=True,
                 verbose_level=1, quiet=True, signal_cut=3, usemomentcube=None,
                 blank_value=0, use_neighbor_as_guess=False,
-                use_best_as_guess=False, start_from_point=(0,0), multicore=1,
+                use_best_as_guess=False, use_cluster_priors=False,
+                start_from_point=(0,0), multicore=1,
                 position_order=None, maskmap=None, **kwargs):
         """
         Fit a spectrum to each valid pixel in the cube
 
         For guesses, priority is *use_best_as_guess* *use_nearest_as_guess*,
-        *usemomentcube*, *guesses*, None
+        *use_cluster_priors*, *usemomentcube*, *guesses*, None
 
         Once you have successfully run this function, the results will be
         stored in the ``.parcube`` and ``.errcube`` attributes, which are each
@@ -1030,6 +1448,9 @@ class SubCube(pyspeckit.Cube):
             If true, the initial guess for the pixel is selected as the one
             giving the least residual among the fits from the neighboring
             pixels and the guess for the pixel
+        use_cluster_priors: bool
+            If true, the guesses are taken from SubCube.cluster_priors,
+            which are computed with SubCube.cluster_guesses if not present
         start_from_point: tuple(int,int)
             Either start from the center or from a point defined by a tuple.
             Work outward from that starting point.
@@ -1067,6 +1488,11 @@ class SubCube(pyspeckit.Cube):
         if not hasattr(self.mapplot,'plane'):
             self.mapplot.makeplane()
 
+        if use_cluster_priors:
+            if not hasattr(self, 'cluster_priors'):
+                self.cluster_guesses()
+            guesses = self.cluster_priors
+
         if maskmap is None:
             maskmap = self.maskmap
 
@@ -1368,6 +1794,88 @@ class SubCube(pyspeckit.Cube):
             log.info("Finished final fit %i.  "
                      "Elapsed time was %0.1f seconds" % (len(valid_pixels), time.time()-t0))
 
+    def fiteach_dask(self, guesses=None, errmap=None, client=None,
+                     chunks=(None, 8, 8), scheduler='processes',
+                     blank_value=np.nan, **kwargs):
+        """
+        Fit a spectrum to each pixel in the cube through a dask task graph.
+
+        The cube is split into spatial tiles, and every tile is fit as a
+        separate task, so the cube does not have to be pickled for every
+        worker process, and slow-converging tiles are balanced across the
+        workers automatically. Requires dask.
+
+        Parameters
+        ----------
+        guesses : tuple or ndarray[naxis=3]
+            Either a tuple/list of guesses with len(guesses) = npars or a
+            cube of guesses with shape [npars, ny, nx]. Defaults to
+            SubCube.best_guesses. Pixels with NaN guesses are not fit.
+        errmap : ndarray[naxis=2] or ndarray[naxis=3]
+            A map of rms of the noise, or an error cube. Defaults to
+            SubCube._rms_map.
+        client : dask.distributed.Client
+            If given, the computation is submitted to this client.
+        chunks : tuple
+            Dask chunks of the cube; the spectral axis is never split.
+        scheduler : string
+            The dask scheduler to use if no client is given.
+        blank_value : float
+            Value to replace non-fitted locations with.
+
+        Additional keyword arguments are passed to the fitter. Those given
+        as [npars, ny, nx] cubes (e.g., SubCube.best_fitargs) are applied
+        pixel by pixel.
+
+        The results are stored in the ``.parcube``, ``.errcube``, and
+        ``.has_fit`` attributes, as in SubCube.fiteach.
+        """
+        import dask.array as da
+
+        if guesses is None:
+            guesses = self.best_guesses
+        guesses = np.asarray(guesses, dtype=float)
+        if guesses.ndim == 1:
+            guesses = np.ones((guesses.size,)+self.cube.shape[1:]) * \
+                      guesses[:, None, None]
+        npars = guesses.shape[0]
+
+        if errmap is None:
+            errmap = self._rms_map
+        errmap = np.asarray(errmap)
+        if errmap.ndim == 2:
+            errmap = errmap[None]
+
+        chunks = (None,) + tuple(chunks[1:])
+        pixel_keys = [key for key, val in kwargs.items()
+                      if np.ndim(val) == 3]
+        pixel_args = [da.from_array(np.asarray(kwargs.pop(key)),
+                                    chunks=chunks) for key in pixel_keys]
+        fitkwargs = {key: list(val) if hasattr(val, 'shape') else val
+                     for key, val in kwargs.items()}
+
+        cube = da.from_array(self.cube, chunks=chunks)
+        result = da.map_blocks(fit_block, cube,
+                               da.from_array(guesses, chunks=chunks),
+                               da.from_array(errmap, chunks=chunks),
+                               *pixel_args, xarr=self.xarr,
+                               fittype=self.fittype, pixel_keys=pixel_keys,
+                               blank_value=blank_value, fitkwargs=fitkwargs,
+                               dtype=float,
+                               chunks=((2*npars,),) + cube.chunks[1:])
+
+        log.info("Fitting %i pixels in %i dask tasks . . ." %
+                 (np.prod(self.cube.shape[1:]), result.npartitions))
+        if client is not None:
+            result = client.compute(result).result()
+        else:
+            result = result.compute(scheduler=scheduler)
+
+        self.parcube, self.errcube = result[:npars], result[npars:]
+        self.has_fit = np.isfinite(self.parcube).all(axis=0)
+        if not np.isnan(blank_value):
+            self.has_fit &= (self.parcube != blank_value).any(axis=0)
+
 
 class SubCubeStack(SubCube, pyspeckit.CubeStack):
     """
@@ -1393,3 +1901,245 @@ def get_neighbors(x, y, shape):
     xpatch, ypatch = zip(*xpyp)
 
     return np.array(xpatch, dtype='int'), np.array(ypatch, dtype='int')
+
+
+def fit_block(cube, guesses, errors, *pixel_args, **kwargs):
+    """
+    Fits every spectrum of a cube tile, a worker function
+    for SubCube.fiteach_dask.
+
+    Parameters
+    ----------
+    cube : (L, y, x)-shaped cube tile
+
+    guesses : (npars, y, x)-shaped guesses for the tile
+
+    errors : (1, y, x) or (L, y, x)-shaped spectral errors
+
+    pixel_args : (npars, y, x)-shaped arrays of fitter keywords,
+                 named by the `pixel_keys` keyword argument
+
+    Other keyword arguments are `xarr`, `fittype`, `blank_value`,
+    and `fitkwargs` to be passed to the fitter.
+
+    Returns
+    -------
+    (2*npars, y, x)-shaped array of the fitted parameters and their errors
+    """
+    xarr, fittype = kwargs['xarr'], kwargs['fittype']
+    pixel_keys, fitkwargs = kwargs['pixel_keys'], kwargs['fitkwargs']
+    npars = guesses.shape[0]
+    result = np.full((2*npars,) + cube.shape[1:], kwargs['blank_value'])
+    for y, x in np.ndindex(cube.shape[1:]):
+        gg, spec = guesses[:, y, x], cube[:, y, x]
+        if not (np.isfinite(gg).all() and np.isfinite(spec).any()):
+            continue
+        sp = pyspeckit.Spectrum(data=spec.copy(), xarr=xarr.copy(),
+                                error=np.ones(spec.shape)*errors[:, y, x])
+        pixel_kwargs = dict(fitkwargs)
+        pixel_kwargs.update({key: list(arr[:, y, x])
+                             for key, arr in zip(pixel_keys, pixel_args)})
+        try:
+            sp.specfit(fittype=fittype, guesses=list(gg), quiet=True,
+                       verbose=False, **pixel_kwargs)
+        except Exception as ex:
+            log.warn("Fit at %i,%i of the tile failed "
+                     "on error %s" % (x, y, str(ex)))
+            continue
+        result[:npars, y, x] = sp.specfit.modelpars
+        result[npars:, y, x] = sp.specfit.modelerrs
+    return result
+
+
+def guess_grid_rows(par_space, rows):
+    """
+    Computes selected rows of a guess grid spanned by all the combinations
+    of parameter values, without making the rest of the grid. The row
+    numbers are decomposed into indices along every parameter axis, the
+    last axis changing the fastest.
+
+    Parameters
+    ----------
+    par_space : a list of 1d arrays of parameter values
+
+    rows : integer array of row numbers in the guess grid
+
+    Returns
+    -------
+    guess_grid : numpy.array of (len(rows), len(par_space)) shape
+    """
+    par_idx = np.unravel_index(rows, [len(p) for p in par_space])
+    guess_grid = np.empty(shape=(np.size(rows), len(par_space)))
+    for i, (values, idx) in enumerate(zip(par_space, par_idx)):
+        guess_grid[:, i] = values[idx]
+    return guess_grid
+
+
+def channel_runs(mask):
+    """
+    Splits a 1d boolean mask into blocks of consecutive True values.
+
+    Returns
+    -------
+    runs : (K, 2)-shaped integer array of the start and stop
+           indices of the K blocks, to be used as slices
+    """
+    edges = np.diff(np.concatenate([[0], np.asarray(mask, dtype=int), [0]]))
+    return np.flatnonzero(edges).reshape(-1, 2)
+
+
+def nearest_channels(xarr_values, values):
+    """
+    Finds the channels closest to the given spectral axis values, same as
+    SpectroscopicAxis.x_to_pix does for a single one, but with a binary
+    search instead of a pass over the whole axis for every value.
+
+    Parameters
+    ----------
+    xarr_values : 1d numpy.array of spectral axis values,
+                  either in ascending or in descending order
+
+    values : float or array of values to look up
+
+    Returns
+    -------
+    channels : integer array of the nearest channel indices
+    """
+    order = np.argsort(xarr_values, kind='stable')
+    sorted_values = xarr_values[order]
+    values = np.asarray(values)
+    pos = np.clip(np.searchsorted(sorted_values, values),
+                  1, sorted_values.size - 1)
+    dist_left = values - sorted_values[pos - 1]
+    dist_right = sorted_values[pos] - values
+    # ties go to the lower channel number, just as np.argmin would do it
+    go_left = (dist_left < dist_right) | ((dist_left == dist_right) &
+                                          (order[pos - 1] < order[pos]))
+    return order[pos - go_left]
+
+
+def squared_residuals(model_grid, D, d2, m2=None, W=None):
+    """
+    Sums of the squared residuals between every model and every spectrum,
+    expanded into |d - m|^2 = |m|^2 - 2 m.d + |d|^2 so that the heavy
+    lifting is done by a single BLAS matrix product.
+
+    Parameters
+    ----------
+    model_grid : (N, L)-shaped array of models
+
+    D : (L, P)-shaped array of spectra
+
+    d2 : P squared norms of the spectra in D
+
+    m2 : N squared norms of the models, computed if not given
+
+    W : optional (L, P)-shaped array of channel weights, zero for the
+        channels without data; D has to be zero on those channels too.
+        If given, the model norms are summed over the weighted channels
+        of every spectrum, and m2 is ignored.
+
+    Returns
+    -------
+    ssr : (N, P)-shaped array of the squared residual sums
+    """
+    # calling BLAS directly guarantees that single precision arrays go
+    # through sgemm; a C-ordered model grid is a Fortran-ordered matrix
+    # when transposed, and is passed as such to avoid a hidden copy
+    gemm = get_blas_funcs('gemm', (model_grid, D))
+    ssr = gemm(-2., model_grid.T, D, trans_a=True)
+    if W is not None:
+        # model norms over the channels with data, pixel by pixel
+        ssr = gemm(1., (model_grid*model_grid).T, W, beta=1., c=ssr,
+                   trans_a=True, overwrite_c=True)
+    else:
+        if m2 is None:
+            m2 = np.einsum('ij,ij->i', model_grid, model_grid)
+        ssr += m2[:, None]
+    ssr += d2[None, :]
+    return ssr
+
+
+def update_best_residuals(ssr, model_ids, best_ssr, best_idx):
+    """
+    Keeps track of the best models found so far when going through the
+    model grid in chunks, so that only P residuals and P model indices
+    have to be kept in between the chunks. The running minima are
+    updated in place.
+
+    Parameters
+    ----------
+    ssr : (N, P)-shaped array of squared residual sums for a chunk of models
+
+    model_ids : N model grid indices for the rows of ssr
+
+    best_ssr : P least squared residual sums found so far
+
+    best_idx : P model grid indices of the best_ssr models
+    """
+    chunk_idx = ssr.argmin(axis=0)
+    chunk_ssr = ssr[chunk_idx, np.arange(ssr.shape[1])]
+    better = chunk_ssr < best_ssr
+    best_ssr[better] = chunk_ssr[better]
+    best_idx[better] = model_ids[chunk_idx[better]]
+
+
+def gaussian_model_grid(xarr, guess_grid, out=None):
+    """
+    Evaluates a sum of gaussian components for every parameter set in the
+    guess grid in one go, following pyspeckit's A*exp(-(x-dx)**2/(2*w**2))
+    convention for the [amplitude, center, width] parameter triplets.
+    Runs through a compiled kernel if numba is available.
+
+    Parameters
+    ----------
+    xarr : 1d numpy.array of spectral axis values, (L,)-shaped
+
+    guess_grid : numpy.array of (..., 3*ncomp) shape
+
+    out : optional (N, L)-shaped numpy.array to write the models into
+
+    Returns
+    -------
+    model_grid : numpy.array of (N, L) shape, where N is the number
+                 of parameter sets in the flattened guess_grid
+    """
+    guess_grid = np.asarray(guess_grid)
+    pars = guess_grid.reshape(-1, guess_grid.shape[-1] // 3, 3)
+    amp, cen, wid = pars[..., 0], pars[..., 1], pars[..., 2]
+    if out is None:
+        out = np.empty(shape=(pars.shape[0], xarr.size))
+
+    if _kernels.HAS_NUMBA:
+        _kernels.gauss_grid(np.ascontiguousarray(xarr, dtype=np.float64),
+                            *[np.ascontiguousarray(p, dtype=np.float64)
+                              for p in (amp, cen, wid)], out=out)
+    else:
+        diff = (xarr[None, None, :] - cen[..., None]) / wid[..., None]
+        out[:] = (amp[..., None] * np.exp(-0.5 * diff**2)).sum(axis=1)
+    return out
+
+
+def lorentzian_model_grid(xarr, guess_grid, out=None):
+    """
+    Evaluates a sum of lorentzian components for every parameter set in the
+    guess grid in one go, following pyspeckit's A/(2*pi)*w/((x-dx)**2+(w/2)**2)
+    convention for the [amplitude, center, width] parameter triplets.
+
+    Parameters and returns are the same as in gaussian_model_grid
+    """
+    guess_grid = np.asarray(guess_grid)
+    pars = guess_grid.reshape(-1, guess_grid.shape[-1] // 3, 3)
+    amp, cen, wid = pars[..., 0], pars[..., 1], pars[..., 2]
+    if out is None:
+        out = np.empty(shape=(pars.shape[0], xarr.size))
+
+    diff = xarr[None, None, :] - cen[..., None]
+    out[:] = (amp[..., None] / (2*np.pi) * wid[..., None]
+              / (diff**2 + (wid[..., None]/2.)**2)).sum(axis=1)
+    return out
+
+
+# models that can be broadcast over the guess grid, keyed on the fittype
+vectorized_models = {'gaussian'  : gaussian_model_grid,
+                     'lorentzian': lorentzian_model_grid}